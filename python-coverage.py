@@ -1,4 +1,13 @@
+import json
+import platform
 import sys
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import sublime
@@ -12,65 +21,93 @@ HERE = Path(__file__).parent
 # https://github.com/berendkleinhaneveld/sublime-doorstop/blob/main/doorstop_plugin.py
 # https://python-watchdog.readthedocs.io/en/stable/
 
-COVERAGE_FILES = {}
-FILE_OBSERVER = None
+# Keeps track of the coverage files, see CoverageManager
+COVERAGE_MANAGER = None
+# Statements parsed from source texts, shared by all views and coverage files.
+# See PythonCoverageEventListener._text_key for the keys.
+STATEMENT_CACHE = OrderedDict()
+STATEMENT_CACHE_LOCK = threading.Lock()
+# Single worker thread that parses source files
+PARSER = None
 
 FileWatcher = None
-LAST_ACTIVE_VIEW = None
+# Maps view ids to the listeners of the views that showed missing lines.
+# Entries disappear by themselves once Sublime drops the listener of a
+# closed view.
+ACTIVE_VIEWS = weakref.WeakValueDictionary()
 
 SETTINGS_FILE = "python-coverage.sublime-settings"
 
+# Names of the bundled wheels (in libs) that need to be on the path
+WHEELS = ("coverage", "watchdog")
+# Settings object of the plugin, see get_settings
+SETTINGS = None
+# Cached value of the show_missing_lines setting, kept up to date by
+# _on_settings_changed so that hot callbacks don't need to load settings
+SHOW_MISSING_LINES = False
 
-def plugin_loaded():
-    """
-    Hook that is called by Sublime when plugin is loaded.
-    """
-    packaging_wheel = HERE / "libs" / "packaging-23.1-py3-none-any.whl"
-    if str(packaging_wheel) not in sys.path:
-        sys.path.append(str(packaging_wheel))
+# Sublime encoding names that can be read from disk with a Python codec
+UTF8_ENCODINGS = {"UTF-8": "utf-8", "UTF-8 with BOM": "utf-8-sig"}
 
-    from packaging.tags import sys_tags
+# Seconds to wait after the last change to a coverage file before reading it
+UPDATE_DELAY = 0.5
 
-    tags = [str(tag) for tag in sys_tags()]
+# Number of times a coverage file that fails to read is retried, before
+# waiting for the next change to it
+MAX_READ_RETRIES = 3
+
+# Seconds during which focus changes in a window with unchanged folders
+# do not trigger a new scan for coverage files
+RESCAN_INTERVAL = 30
+
+# Maximum number of parsed texts to remember
+STATEMENT_CACHE_SIZE = 128
 
-    for prefix in {"coverage*", "watchdog*"}:
-        # Figure out the right whl for the platform
-        for wheel in (HERE / "libs").glob(prefix):
-            wheel_tag = "-".join(wheel.stem.split("-")[2:])
-            if wheel_tag in tags:
-                break
-        else:
-            print(f"Could not find compatible {prefix} wheel for your platform")
-            return
 
-        if str(wheel) not in sys.path:
+def plugin_loaded():
+    """
+    Hook that is called by Sublime when plugin is loaded.
+    """
+    settings = get_settings()
+    settings.add_on_change("python-coverage", _on_settings_changed)
+    _on_settings_changed()
+
+    wheels = find_wheels()
+    if wheels is None:
+        return
+
+    # Reloading the plugin finds the wheels on the path already
+    sys_path = set(sys.path)
+    for wheel in wheels:
+        if str(wheel) not in sys_path:
             sys.path.append(str(wheel))
 
-    from watchdog.observers import Observer
+    global PARSER
+    PARSER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="python-coverage")
 
-    # TODO: only start watching when plugin is showing missing lines
-    global FILE_OBSERVER
-    FILE_OBSERVER = Observer()
-    FILE_OBSERVER.start()
+    from watchdog.events import PatternMatchingEventHandler
 
-    from watchdog.events import FileSystemEventHandler
+    class _FileWatcher(PatternMatchingEventHandler):
+        """
+        Handles changes to the coverage files within a single directory.
+        """
 
-    class _FileWatcher(FileSystemEventHandler):
-        def __init__(self, file):
-            super().__init__()
-            self.file = file
+        def __init__(self, manager, directory):
+            super().__init__(patterns=["*.coverage"], ignore_directories=True)
+            self.manager = manager
+            # Path of the coverage file of the directory, as watchdog reports it
+            self.coverage_file = str(Path(directory) / ".coverage")
 
         def _update(self, event):
-            if not event.src_path.endswith(".coverage"):
-                return
-
-            if str(event.src_path) != str(self.file):
+            cov = self.manager.coverage_files.get(event.src_path)
+            if cov is None and event.src_path == self.coverage_file:
+                # Coverage removes the file at the start of a run, so pick
+                # it up again once it is written
+                cov = self.manager.add_coverage_file(event.src_path)
+            if cov is None:
                 return
 
-            COVERAGE_FILES[self.file].update()
-
-            if LAST_ACTIVE_VIEW:
-                LAST_ACTIVE_VIEW._update_regions()
+            self.manager.mark_dirty(cov)
 
         def on_modified(self, event):
             self._update(event)
@@ -78,62 +115,586 @@ def plugin_loaded():
         def on_created(self, event):
             self._update(event)
 
+        def on_deleted(self, event):
+            # Nothing left to read, so there is no need to wait for more
+            # changes
+            self.manager.remove_coverage_file(event.src_path)
+
     global FileWatcher
     FileWatcher = _FileWatcher
 
+    # TODO: only start watching when plugin is showing missing lines
+    global COVERAGE_MANAGER
+    COVERAGE_MANAGER = CoverageManager()
+    COVERAGE_MANAGER.initialize(settings)
+
+
+def find_wheels():
+    """
+    Finds the coverage and watchdog wheels that are compatible with this
+    platform. The result is cached, so that the supported tags only have
+    to be computed once per platform.
+
+    Returns:
+        List of wheel paths, or None if no compatible wheel could be found.
+    """
+    libs = HERE / "libs"
+    cache_file = Path(sublime.cache_path()) / "python-coverage" / "wheels.json"
+    cache_key = f"{sys.version} {sys.platform} {platform.machine()}"
+    try:
+        cache = json.loads(cache_file.read_text())
+        if cache["key"] == cache_key:
+            wheels = [libs / name for name in cache["wheels"]]
+            if all(wheel.is_file() for wheel in wheels):
+                return wheels
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    packaging_wheel = libs / "packaging-23.1-py3-none-any.whl"
+    if str(packaging_wheel) not in sys.path:
+        sys.path.append(str(packaging_wheel))
+
+    from packaging.tags import sys_tags
+    from packaging.utils import parse_wheel_filename
+
+    tags = set(sys_tags())
+    # Figure out the right whl for the platform, in a single pass over libs
+    wheels = {}
+    for wheel in libs.glob("*.whl"):
+        name, _, _, wheel_tags = parse_wheel_filename(wheel.name)
+        if name in WHEELS and name not in wheels and not tags.isdisjoint(wheel_tags):
+            wheels[name] = wheel
+
+    for name in WHEELS:
+        if name not in wheels:
+            print(f"Could not find compatible {name} wheel for your platform")
+            return None
+
+    wheels = [wheels[name] for name in WHEELS]
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(
+            json.dumps({"key": cache_key, "wheels": [wheel.name for wheel in wheels]})
+        )
+    except OSError:
+        pass
+    return wheels
+
 
 def plugin_unloaded():
     """
     Hook that is called by Sublime when plugin is unloaded.
     """
-    COVERAGE_FILES.clear()
-    global FILE_OBSERVER
-    FILE_OBSERVER.stop()
-    FILE_OBSERVER.join()
-    FILE_OBSERVER = None
-    global LAST_ACTIVE_VIEW
-    LAST_ACTIVE_VIEW = None
+    global SETTINGS
+    get_settings().clear_on_change("python-coverage")
+    SETTINGS = None
+    global COVERAGE_MANAGER
+    if COVERAGE_MANAGER:
+        COVERAGE_MANAGER.shutdown()
+        COVERAGE_MANAGER = None
+    global PARSER
+    if PARSER:
+        PARSER.shutdown(wait=False)
+        PARSER = None
+    STATEMENT_CACHE.clear()
+    ACTIVE_VIEWS.clear()
+
+
+def get_settings():
+    """
+    Returns:
+        The settings of the plugin. Sublime keeps the object up to date, so
+        it only needs to be loaded once.
+    """
+    global SETTINGS
+    if SETTINGS is None:
+        SETTINGS = sublime.load_settings(SETTINGS_FILE)
+    return SETTINGS
 
 
-class CoverageFile:
-    def __init__(self, coverage_file):
-        import coverage
+def _on_settings_changed():
+    global SHOW_MISSING_LINES
+    SHOW_MISSING_LINES = bool(get_settings().get("show_missing_lines", False))
 
-        self.coverage_file = coverage_file
-        self.data = coverage.Coverage(data_file=coverage_file).get_data()
-        self.data.read()
 
-        self.handler = FileWatcher(coverage_file)
-        self.watcher = FILE_OBSERVER.schedule(self.handler, str(coverage_file.parent))
+class Debouncer:
+    """
+    Runs callbacks on a single background thread, once no new request
+    has been scheduled for the same key during the delay.
+    """
 
-    def update(self):
-        self.data.read()
+    def __init__(self, delay):
+        self.delay = delay
+        # Maps keys to (deadline, callback)
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="python-coverage-debouncer", daemon=True
+        )
+        self._thread.start()
+
+    def schedule(self, key, callback):
+        """
+        Schedules the callback to run after the delay, replacing any
+        pending callback for the same key.
+        """
+        with self._condition:
+            self._pending[key] = (time.monotonic() + self.delay, callback)
+            self._condition.notify()
+
+    def stop(self):
+        """
+        Drops all pending callbacks and stops the thread.
+        """
+        with self._condition:
+            self._running = False
+            self._pending.clear()
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                callbacks = self._wait_for_expired()
+                if not self._running:
+                    return
+
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    traceback.print_exc()
+
+    def _wait_for_expired(self):
+        """
+        Waits (with the condition held) until the thread is stopped or
+        callbacks are due, and returns the due callbacks.
+        """
+        while self._running:
+            now = time.monotonic()
+            expired = [
+                key for key, (deadline, _) in self._pending.items() if deadline <= now
+            ]
+            if expired:
+                return [self._pending.pop(key)[1] for key in expired]
+
+            timeout = None
+            if self._pending:
+                timeout = min(deadline for deadline, _ in self._pending.values()) - now
+            self._condition.wait(timeout)
+        return []
+
+
+class CoverageManager:
+    """
+    Keeps track of the coverage files in the open folders. Watches them for
+    changes and redraws the views they cover once the changes settled.
+    """
+
+    def __init__(self):
+        # Maps coverage file paths (as str) to their CoverageFile
+        self.coverage_files = {}
+        # Maps folders (as str) to the CoverageFile in that folder
+        self._by_folder = {}
+        # Maps view file names to their CoverageFile (or None), reset whenever
+        # coverage_files changes
+        self._for_file = {}
+        # Guards changes to the maps above, which are updated from both
+        # Sublime's main and async threads
+        self._lock = threading.Lock()
+        # Maps changed coverage files to whether their data must be reloaded
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._observer = None
+        # Maps watched directories to their watchdog ObservedWatch
+        self._watched_directories = {}
+        self._debouncer = None
+
+    def initialize(self, settings):
+        """
+        Starts watching for changes to coverage files.
+        """
+        if settings.get("force_polling", False):
+            # Native file system events can be unreliable, for instance on
+            # network drives. Note that each poll lists and stats the whole
+            # directory of the coverage file, often the project root.
+            from watchdog.observers.polling import PollingObserver
+
+            self._observer = PollingObserver(timeout=settings.get("watch_interval", 5))
+        else:
+            from watchdog.observers import Observer
+
+            self._observer = Observer()
+        self._observer.start()
+        self._debouncer = Debouncer(UPDATE_DELAY)
+
+    def shutdown(self):
+        """
+        Stops watching and forgets about all coverage files.
+        """
+        self._debouncer.stop()
+        self._observer.stop()
+        self._observer.join()
+        with self._lock:
+            self.coverage_files.clear()
+            self._by_folder.clear()
+            self._for_file.clear()
+            self._watched_directories.clear()
+        with self._pending_lock:
+            self._pending.clear()
+
+    def add_coverage_file(self, key):
+        """
+        Starts tracking the coverage file, if it exists and is not tracked yet.
+
+        Args:
+            key: path of the coverage file (as str)
+
+        Returns:
+            The CoverageFile, or None if there is no such file.
+        """
+        # Plain str key, so known coverage files take a single dict lookup
+        cov = self.coverage_files.get(key)
+        if cov is not None:
+            return cov
+
+        coverage_file = Path(key)
+        if not coverage_file.is_file():
+            return None
+
+        directory = str(coverage_file.parent)
+        with self._lock:
+            # Both the watcher thread and Sublime's async thread add files,
+            # so the other one might have been first
+            cov = self.coverage_files.get(key)
+            if cov is not None:
+                return cov
+
+            cov = CoverageFile(coverage_file, self)
+            self.coverage_files[key] = cov
+            self._by_folder[directory] = cov
+            self._for_file.clear()
+            # One watch per directory, even if it is shared with another
+            # coverage file. Claimed here, but scheduled below.
+            watch = directory not in self._watched_directories
+            if watch:
+                self._watched_directories[directory] = None
+
+        if watch:
+            # Watchdog holds the observer lock while the handlers run, and
+            # they take self._lock, so never schedule while holding it
+            observed_watch = self._observer.schedule(
+                FileWatcher(self, directory), directory
+            )
+            with self._lock:
+                self._watched_directories[directory] = observed_watch
+        return cov
+
+    def remove_coverage_file(self, key):
+        """
+        Stops tracking the coverage file and redraws the views it covered.
+        The directory stays watched, so the file is tracked again as soon
+        as it is written again.
+
+        Args:
+            key: path of the coverage file (as str)
+        """
+        with self._lock:
+            cov = self.coverage_files.pop(key, None)
+            if cov is None:
+                return
+            directory = str(cov.coverage_file.parent)
+            if self._by_folder.get(directory) is cov:
+                del self._by_folder[directory]
+            self._for_file.clear()
+
+        with self._pending_lock:
+            self._pending.pop(cov, None)
+        # Which views the file covered is no longer known, but views that
+        # did not change return early from _update_regions
+        sublime.set_timeout_async(partial(self._redraw_views, None), 0)
+
+    def get_coverage_for_file(self, file_name):
+        """
+        Returns:
+            The CoverageFile of the (innermost) folder that contains the given
+            file, or None if there is no such coverage file.
+        """
+        try:
+            return self._for_file[file_name]
+        except KeyError:
+            pass
+
+        folders = [str(folder) for folder in Path(file_name).parents]
+        with self._lock:
+            # Walk up from the file, so the innermost folder is found first
+            result = None
+            for folder in folders:
+                result = self._by_folder.get(folder)
+                if result is not None:
+                    break
+
+            self._for_file[file_name] = result
+        return result
+
+    def mark_dirty(self, cov, reload=True):
+        """
+        Schedules the views covered by the coverage file to be redrawn. Can be
+        called from any thread.
+
+        Args:
+            cov: the changed CoverageFile
+            reload: whether the data of the coverage file changed and has to
+                be read again
+        """
+        with self._pending_lock:
+            self._pending[cov] = self._pending.get(cov, False) or reload
+        # Coverage writes the file in several steps, so wait for the writes to
+        # settle before reading it. All coverage files share a single key, so
+        # a test session that writes several of them ends in a single flush.
+        self._debouncer.schedule("flush", self._flush)
+
+    def _flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+
+        # Views of files that turn out to be unchanged need no redraw
+        changed = frozenset(
+            cov
+            for cov, reload in pending.items()
+            if (cov.update() if reload else cov.retry())
+        )
+        if changed:
+            # The views are redrawn on Sublime's async thread, which is also
+            # the only thread that touches ACTIVE_VIEWS
+            sublime.set_timeout_async(partial(self._redraw_views, changed), 0)
+
+    def _redraw_views(self, changed):
+        """
+        Redraws the views that are covered by one of the changed coverage
+        files, or all views if changed is None.
+        """
+        if not SHOW_MISSING_LINES:
+            # Nothing is shown, views update once they are activated again
+            return
+
+        for view_listener in list(ACTIVE_VIEWS.values()):
+            file_name = view_listener.view.file_name()
+            if not file_name:
+                continue
+            if changed is None or self.get_coverage_for_file(file_name) in changed:
+                view_listener._update_regions()
+
+
+def get_statements(key, read_text):
+    """
+    Args:
+        key: key that identifies the text
+        read_text: callable returning the text, or None if the text no
+            longer matches the key. Only called when there are no statements
+            cached for the key.
+
+    Returns:
+        Sorted tuple with the line numbers of the statements in the text, or
+        None if the text changed before it could be read.
+    """
+    from coverage.parser import PythonParser
+
+    with STATEMENT_CACHE_LOCK:
+        statements = STATEMENT_CACHE.get(key)
+        if statements is not None:
+            STATEMENT_CACHE.move_to_end(key)
+            return statements
+
+    text = read_text()
+    if text is None:
+        return None
+
+    python_parser = PythonParser(text=text)
+    python_parser.parse_source()
+    statements = tuple(sorted(python_parser.statements))
+
+    with STATEMENT_CACHE_LOCK:
+        STATEMENT_CACHE[key] = statements
+        if len(STATEMENT_CACHE) > STATEMENT_CACHE_SIZE:
+            STATEMENT_CACHE.popitem(last=False)
+    return statements
+
+
+def read_file_text(file_name, mtime_ns, encoding):
+    """
+    Returns:
+        The text of the file, or None if it can not be read or was modified
+        since mtime_ns.
+    """
+    path = Path(file_name)
+    try:
+        text = path.read_text(encoding=encoding)
+        if path.stat().st_mtime_ns != mtime_ns:
+            return None
+    except (OSError, UnicodeDecodeError):
+        return None
+    return text
 
-    def in_coverage_data(self, file):
-        return str(file) in self.data.measured_files()
 
-    def missing_lines(self, file, text):
+class CoverageFile:
+    def __init__(self, coverage_file, manager):
+        self.coverage_file = coverage_file
+        self.manager = manager
+        # Coverage data is only read once it is actually needed
+        self.data = None
+        self._data_loaded = False
+        self._read_retries = 0
+        # Set when a read failed, so that other views do not read the file
+        # again until the scheduled retry or the next change
+        self._read_failed = False
+        # (mtime, size) of the file when the data was last read
+        self._read_stat = None
+        # Incremented every time the data is (re)read
+        self.revision = 0
+        self._measured_files = frozenset()
+        # Covered lines per measured file, filled on demand
+        self._lines_cache = {}
+
+    def _ensure_loaded(self):
+        """
+        Reads the coverage data if it was not read yet, or if it was
+        invalidated by an update.
+
+        Returns:
+            Whether the coverage data is available.
+        """
+        if self._data_loaded:
+            return True
+        if self._read_failed:
+            return False
+
         from coverage.exceptions import DataError
-        from coverage.parser import PythonParser
 
+        if self.data is None:
+            import coverage
+
+            self.data = coverage.Coverage(data_file=self.coverage_file).get_data()
+        # Taken before reading, so that a write during the read counts as a
+        # change on the next update
+        stat = self._stat()
         try:
-            lines = self.data.lines(file)
+            self.data.read()
         except DataError:
+            # Most likely the file is still being written: try again once
+            # it has settled instead of blocking until it is complete
+            self._read_failed = True
+            if self._read_retries < MAX_READ_RETRIES:
+                self._read_retries += 1
+                self.manager.mark_dirty(self, reload=False)
+            return False
+
+        self._read_retries = 0
+        self._read_stat = stat
+        self._measured_files = frozenset(self.data.measured_files())
+        self._lines_cache.clear()
+        self.revision += 1
+        self._data_loaded = True
+        return True
+
+    def update(self):
+        """
+        Invalidates the coverage data, unless the file is unchanged since it
+        was read (some writes and tools only touch the file).
+
+        Returns:
+            Whether the data was invalidated.
+        """
+        if self._data_loaded and self._read_stat is not None:
+            if self._stat() == self._read_stat:
+                return False
+
+        # Defer reading until the data is requested again
+        self._data_loaded = False
+        self._read_failed = False
+        self._read_retries = 0
+        return True
+
+    def retry(self):
+        """
+        Allows the next request for the data to read the file again, after
+        a failed read.
+
+        Returns:
+            Always True, the views need to be redrawn.
+        """
+        self._read_failed = False
+        return True
+
+    def _stat(self):
+        """
+        Returns:
+            Tuple of the mtime (in ns) and size of the file, or None if it
+            can not be read.
+        """
+        try:
+            stat = self.coverage_file.stat()
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def in_coverage_data(self, file):
+        return self._ensure_loaded() and str(file) in self._measured_files
+
+    def missing_lines(self, file, text_key, read_text):
+        """
+        Args:
+            file: name of the source file
+            text_key: key that identifies the current text of the file, used
+                to reuse the statements parsed from it earlier
+            read_text: callable returning the text of the file, only called
+                when the statements need to be parsed
+
+        Returns:
+            Sorted list of the lines with statements that were not run, or
+            None if there is no coverage data for the file or the text
+            changed before it could be read.
+        """
+        if not self._ensure_loaded():
             return None
+
+        lines = self._covered_lines(file)
         if lines is None:
             return None
 
-        # TODO: Maybe this could be cached? And use file watcher to invalidate?
-        python_parser = PythonParser(text=text)
-        python_parser.parse_source()
-        statements = python_parser.statements
+        statements = get_statements(text_key, read_text)
+        if statements is None:
+            return None
+        return [line for line in statements if line not in lines]
+
+    def _covered_lines(self, file):
+        """
+        Returns:
+            Frozenset of the lines of the file that were run, or None if
+            there is no line data for the file.
+        """
+        try:
+            return self._lines_cache[file]
+        except KeyError:
+            pass
+
+        from coverage.exceptions import DataError
+
+        try:
+            lines = self.data.lines(file)
+        except DataError:
+            lines = None
+        if lines is not None:
+            lines = frozenset(lines)
 
-        return sorted(list(statements - set(lines)), reverse=True)
+        self._lines_cache[file] = lines
+        return lines
 
 
 class ToggleMissingLinesCommand(sublime_plugin.ApplicationCommand):
     def run(self):
-        settings = sublime.load_settings(SETTINGS_FILE)
+        settings = get_settings()
         settings["show_missing_lines"] = not settings["show_missing_lines"]
         sublime.save_settings(SETTINGS_FILE)
         print(
@@ -152,6 +713,11 @@ class PythonCoverageDataFileListener(sublime_plugin.EventListener):
         """
         return True
 
+    def __init__(self):
+        super().__init__()
+        # Maps window ids to the folders that were last scanned, and when
+        self._last_scans = {}
+
     def on_new_project_async(self, window):
         """
         Called right after a new project is created, passed the Window object.
@@ -180,17 +746,39 @@ class PythonCoverageDataFileListener(sublime_plugin.EventListener):
         self.update_available_coverage_files(window)
 
     def on_activated_async(self, view):
-        self.update_available_coverage_files(view.window())
+        window = view.window()
+        if window:
+            self.update_available_coverage_files(window, force=False)
+
+    def update_available_coverage_files(self, window, force=True):
+        """
+        Looks for coverage files in the folders of the window.
+
+        Args:
+            window: the window to scan
+            force: when False, the scan is skipped if the folders of the
+                window are unchanged and were scanned recently
+        """
+        manager = COVERAGE_MANAGER
+        if not SHOW_MISSING_LINES or manager is None:
+            return
 
-    def update_available_coverage_files(self, window):
-        settings = sublime.load_settings(SETTINGS_FILE)
-        if not settings["show_missing_lines"]:
+        folders = window.folders()
+        scan = (frozenset(folders), time.monotonic())
+        last_scan = self._last_scans.get(window.id())
+        if (
+            not force
+            and last_scan
+            and last_scan[0] == scan[0]
+            and scan[1] - last_scan[1] < RESCAN_INTERVAL
+        ):
             return
-        for folder in window.folders():
-            folder = Path(folder)
-            coverage_file = folder / ".coverage"
-            if coverage_file.is_file() and coverage_file not in COVERAGE_FILES:
-                COVERAGE_FILES[coverage_file] = CoverageFile(coverage_file)
+        self._last_scans[window.id()] = scan
+
+        for folder in folders:
+            # Joined by Path, so the key matches the paths watchdog reports,
+            # also for drive roots
+            manager.add_coverage_file(str(Path(folder) / ".coverage"))
 
 
 class PythonCoverageEventListener(sublime_plugin.ViewEventListener):
@@ -202,58 +790,83 @@ class PythonCoverageEventListener(sublime_plugin.ViewEventListener):
         """
         return "Python" in settings.get("syntax", "")
 
+    def __init__(self, view):
+        super().__init__(view)
+        # Whether the regions are known to be erased since they were last
+        # added. Starts out False, because regions might be left over from
+        # an earlier plugin load.
+        self._regions_cleared = False
+        # What the regions were last drawn from: (CoverageFile, revision,
+        # text key), or None
+        self._last_painted = None
+
     def on_modified_async(self):
         """
         Called after changes have been made to the view.
         Runs in a separate thread, and does not block the application.
         """
-        pass
-        # TODO: clear the modified region(s), if any
+        # The missing lines no longer match the text, so clear them once
+        # until the next update instead of on every keystroke
+        self._erase_regions()
 
     def on_activated_async(self):
         """
         Called when a view gains input focus. Runs in a separate thread,
         and does not block the application.
         """
-        settings = sublime.load_settings(SETTINGS_FILE)
-        if not settings["show_missing_lines"]:
-            self.view.erase_regions(key="python-coverage")
+        if not SHOW_MISSING_LINES:
+            ACTIVE_VIEWS.pop(self.view.id(), None)
+            self._erase_regions()
             return
 
-        global LAST_ACTIVE_VIEW
-        LAST_ACTIVE_VIEW = self
+        ACTIVE_VIEWS[self.view.id()] = self
 
         self._update_regions()
 
     def _update_regions(self):
         file_name = self.view.file_name()
-        if not file_name:
+        manager = COVERAGE_MANAGER
+        if not file_name or manager is None:
             return
 
-        for coverage_file in COVERAGE_FILES:
-            # Assume that the file is somewhere within the
-            # same (sub)folder as the coverage file
-            if str(coverage_file.parent) in file_name:
-                break
-        else:
-            self.view.erase_regions(key="python-coverage")
+        # Assume that the file is somewhere within the
+        # same (sub)folder as the coverage file
+        cov = manager.get_coverage_for_file(file_name)
+        if cov is None or not cov.in_coverage_data(file_name):
+            self._erase_regions()
             return
 
-        cov = COVERAGE_FILES[coverage_file]
-        if not cov.in_coverage_data(file_name):
-            self.view.erase_regions(key="python-coverage")
+        text_key = self._text_key()
+        painted = (cov, cov.revision, text_key)
+        if painted == self._last_painted:
+            # Neither the coverage data nor the text changed since last time
             return
 
-        full_file_region = sublime.Region(0, self.view.size())
-        text = self.view.substr(full_file_region)
+        if text_key not in STATEMENT_CACHE:
+            # Parse on the parser thread and update again once that is done,
+            # instead of keeping Sublime's async thread busy
+            future = PARSER.submit(
+                get_statements, text_key, self._text_reader(text_key)
+            )
+            future.add_done_callback(partial(self._on_parsed, text_key))
+            return
 
-        missing = cov.missing_lines(file_name, text)
+        missing = cov.missing_lines(file_name, text_key, self._text_reader(text_key))
         if not missing:
-            self.view.erase_regions(key="python-coverage")
+            self._erase_regions()
+            self._last_painted = painted
             return
 
-        all_lines_regions = self.view.lines(full_file_region)
-        missing_regions = [all_lines_regions[line - 1] for line in missing]
+        # Only look up the lines that are missing, not every line in the view,
+        # and use one region per run of consecutive lines
+        missing_regions = []
+        start = end = missing[0]
+        for line in missing[1:]:
+            if line != end + 1:
+                missing_regions.append(self._lines_region(start, end))
+                start = line
+            end = line
+        missing_regions.append(self._lines_region(start, end))
 
         self.view.add_regions(
             key="python-coverage",
@@ -262,6 +875,78 @@ class PythonCoverageEventListener(sublime_plugin.ViewEventListener):
             icon="Packages/sublime-python-coverage/images/triangle.png",
             flags=sublime.RegionFlags.HIDDEN,
         )
+        self._regions_cleared = False
+        self._last_painted = painted
+
+    def _lines_region(self, start, end):
+        """
+        Returns:
+            Region that spans the lines start up to and including end
+            (1-based), without the newline of the last line.
+        """
+        return sublime.Region(
+            self.view.text_point(start - 1, 0),
+            self.view.line(self.view.text_point(end - 1, 0)).b,
+        )
+
+    def _on_parsed(self, text_key, future):
+        error = future.exception()
+        if error:
+            traceback.print_exception(type(error), error, error.__traceback__)
+            return
+        if future.result() is None:
+            # The text changed before it was read, the next update parses it
+            return
+        sublime.set_timeout_async(partial(self._update_parsed, text_key), 0)
+
+    def _update_parsed(self, text_key):
+        # Skip the update if the text changed while it was parsed
+        if self._text_key() == text_key:
+            self._update_regions()
+
+    def _erase_regions(self):
+        self._last_painted = None
+        if self._regions_cleared:
+            return
+        self.view.erase_regions(key="python-coverage")
+        self._regions_cleared = True
+
+    def _text_key(self):
+        """
+        Returns:
+            Key that identifies the current text of the view. An unmodified
+            UTF-8 view is identified by the file on disk, so all views of that
+            file share the parsed statements.
+        """
+        encoding = UTF8_ENCODINGS.get(self.view.encoding())
+        if encoding and not self.view.is_dirty():
+            file_name = self.view.file_name()
+            try:
+                return (file_name, Path(file_name).stat().st_mtime_ns, encoding)
+            except OSError:
+                pass
+
+        return (self.view.buffer_id(), self.view.change_count())
+
+    def _text_reader(self, text_key):
+        """
+        Returns:
+            Callable returning the text identified by the key, or None if
+            that text is gone. It reads from the same source the key was
+            made for, so it can safely be called later from another thread.
+        """
+        if isinstance(text_key[0], str):
+            # Read the file from disk, even if the view was modified since,
+            # which avoids copying the whole buffer out of Sublime
+            return partial(read_file_text, *text_key)
+        return partial(self._read_buffer, text_key[1])
+
+    def _read_buffer(self, change_count):
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        # Checked after reading, so the text can not be newer than the key
+        if self.view.change_count() != change_count:
+            return None
+        return text
 
     def on_hover(self, point, hover_zone):
         """